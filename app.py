@@ -1,11 +1,17 @@
 import os
 import csv
-from io import StringIO
+from functools import lru_cache
+from threading import Lock
+from cachetools import TTLCache
 from flask import (
     Flask, render_template, request, redirect,
-    url_for, flash, Response, jsonify
+    url_for, flash, Response, jsonify, stream_with_context, abort
 )
 from flask_sqlalchemy import SQLAlchemy
+from flask_caching import Cache
+from sqlalchemy import event, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import joinedload
 
 # ---- Login ----
 from flask_login import (
@@ -29,8 +35,40 @@ app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DB_PATH}"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-secret-key")
+# CSRF tokens live for the whole session instead of expiring after an hour.
+app.config["WTF_CSRF_TIME_LIMIT"] = None
+# Werkzeug hash method with an explicit cost; raise the iteration count as
+# hardware allows; older hashes are upgraded on the next successful login.
+app.config["PASSWORD_HASH_METHOD"] = os.environ.get("PASSWORD_HASH_METHOD", "pbkdf2:sha256:600000")
+
+# SimpleCache lives in each worker process, so a write only clears the
+# worker that handled it; multi-worker deploys should point CACHE_TYPE at a
+# shared backend (e.g. RedisCache + CACHE_REDIS_URL) or keep the timeout short.
+app.config["CACHE_TYPE"] = os.environ.get("CACHE_TYPE", "SimpleCache")
+app.config["CACHE_REDIS_URL"] = os.environ.get("CACHE_REDIS_URL")
+app.config["CLASS_STATS_CACHE_TIMEOUT"] = int(os.environ.get("CLASS_STATS_CACHE_TIMEOUT", 60))
 
 db = SQLAlchemy(app)
+cache = Cache(app)
+
+
+# ---------------- TEMPLATE HELPERS ---------------- #
+
+@lru_cache(maxsize=4096)
+def _cached_url_for(script_root, endpoint, values_items):
+    return url_for(endpoint, **dict(values_items))
+
+
+def cached_url_for(endpoint, **values):
+    # The URL map is fixed once the app is running, so relative URLs only
+    # depend on the endpoint, its arguments and the script root. External
+    # URLs and other "_"-prefixed options depend on the request; skip the cache.
+    if any(key.startswith("_") for key in values):
+        return url_for(endpoint, **values)
+    return _cached_url_for(request.script_root, endpoint, tuple(sorted(values.items())))
+
+
+app.jinja_env.globals["url_for"] = cached_url_for
 
 
 # ---------------- LOGIN MANAGER ---------------- #
@@ -38,34 +76,45 @@ db = SQLAlchemy(app)
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
 
+# Checked against when the username is unknown, so a failed login costs
+# the same hash verification whether or not the user exists.
+DUMMY_HASH = generate_password_hash("dummy-password", method=app.config["PASSWORD_HASH_METHOD"])
+# Werkzeug fills in default parameters, so compare against what it actually
+# stores (e.g. "pbkdf2:sha256:600000") rather than the configured method.
+HASH_METHOD_PREFIX = DUMMY_HASH.split("$", 1)[0]
+
 
 # ---------------- MODELS ---------------- #
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(120), unique=True, nullable=False)
+    username = db.Column(db.String(120), unique=True, nullable=False, index=True)
     password_hash = db.Column(db.String(256), nullable=False)
 
     def set_password(self, raw):
-        self.password_hash = generate_password_hash(raw)
+        self.password_hash = generate_password_hash(raw, method=app.config["PASSWORD_HASH_METHOD"])
+        if self.id is not None:
+            _user_cache_invalidate(self.id)
 
     def check_password(self, raw):
         return check_password_hash(self.password_hash, raw)
 
+    def needs_rehash(self):
+        return self.password_hash.split("$", 1)[0] != HASH_METHOD_PREFIX
+
 
 class Student(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(120), nullable=False)
-    roll_number = db.Column(db.String(50), unique=True, nullable=False)
-    grades = db.relationship("Grade", backref="student", cascade="all, delete-orphan")
-
-    def average(self):
-        return round(sum(g.score for g in self.grades) / len(self.grades), 2) if self.grades else None
+    name = db.Column(db.String(120), nullable=False, index=True)
+    roll_number = db.Column(db.String(50), unique=True, nullable=False, index=True)
+    grades = db.relationship("Grade", backref="student", cascade="save-update, merge, delete",
+                             passive_deletes=True, lazy="selectin", order_by="Grade.subject")
 
 
 class Grade(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    student_id = db.Column(db.Integer, db.ForeignKey("student.id"), nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey("student.id", ondelete="CASCADE"),
+                           nullable=False, index=True)
     subject = db.Column(db.String(80), nullable=False)
     score = db.Column(db.Float, nullable=False)
 
@@ -86,15 +135,156 @@ class RegisterForm(FlaskForm):
 
 # ---------------- USER LOADER ---------------- #
 
+_user_cache = TTLCache(maxsize=1024, ttl=60)
+_user_cache_lock = Lock()
+
+
+def _user_cache_get(user_id):
+    with _user_cache_lock:
+        user = _user_cache.get(user_id)
+    if user is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            # Detach the copy so later commits can't expire its attributes.
+            db.session.expunge(user)
+            with _user_cache_lock:
+                _user_cache[user_id] = user
+    return user
+
+
+def _user_cache_invalidate(user_id):
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return _user_cache_get(int(user_id))
+
+
+# ---------------- QUERY HELPERS ---------------- #
+
+def ensure_student_exists(student_id):
+    if db.session.query(Student.id).filter_by(id=student_id).scalar() is None:
+        abort(404)
+
+
+# ---------------- SQLITE PRAGMAS ---------------- #
+
+def set_sqlite_pragmas(dbapi_conn, _):
+    cur = dbapi_conn.cursor()
+    # SQLite leaves FK enforcement off per connection; ON DELETE CASCADE needs it.
+    cur.execute("PRAGMA foreign_keys=ON")
+    # WAL lets dashboard reads proceed while a write is in progress.
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA cache_size=-64000")
+    cur.execute("PRAGMA mmap_size=134217728")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.close()
+
+
+# ---------------- FULL-TEXT SEARCH ---------------- #
+
+# External-content FTS5 index over student name/roll, kept in sync by triggers.
+# The trigram tokenizer makes MATCH a case-insensitive substring search, the
+# same results as ILIKE '%q%', for queries of at least three characters.
+SEARCH_MIN_QUERY_LEN = 3
+SEARCH_INDEX_DDL = [
+    """CREATE VIRTUAL TABLE student_fts USING fts5(
+        name, roll_number, content='student', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS student_ai AFTER INSERT ON student BEGIN
+        INSERT INTO student_fts(rowid, name, roll_number)
+        VALUES (new.id, new.name, new.roll_number);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS student_ad AFTER DELETE ON student BEGIN
+        INSERT INTO student_fts(student_fts, rowid, name, roll_number)
+        VALUES ('delete', old.id, old.name, old.roll_number);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS student_au AFTER UPDATE ON student BEGIN
+        INSERT INTO student_fts(student_fts, rowid, name, roll_number)
+        VALUES ('delete', old.id, old.name, old.roll_number);
+        INSERT INTO student_fts(rowid, name, roll_number)
+        VALUES (new.id, new.name, new.roll_number);
+    END""",
+]
+
+
+def create_search_index():
+    """Create the FTS table if needed; returns False when SQLite lacks FTS5/trigram."""
+    existing = db.session.execute(
+        text("SELECT sql FROM sqlite_master WHERE type='table' AND name='student_fts'")
+    ).scalar()
+    if existing and "trigram" in existing:
+        return True
+
+    try:
+        if existing:
+            # Built with an older word tokenizer; rebuild it as trigram.
+            drop_search_index()
+        for stmt in SEARCH_INDEX_DDL:
+            db.session.execute(text(stmt))
+        # Index any students that were added before the table existed.
+        db.session.execute(text("INSERT INTO student_fts(student_fts) VALUES ('rebuild')"))
+        db.session.commit()
+    except OperationalError:
+        db.session.rollback()
+        print("⚠️ SQLite FTS5 trigram search unavailable; using ILIKE search")
+        return False
+    return True
+
+
+def drop_search_index():
+    for name in ("student_ai", "student_ad", "student_au"):
+        db.session.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+    db.session.execute(text("DROP TABLE IF EXISTS student_fts"))
+    db.session.commit()
+
+
+def student_search_filter(q, use_fts=True):
+    """Filter matching students whose name or roll contains q."""
+    if use_fts and app.config["SEARCH_INDEX_AVAILABLE"] and len(q) >= SEARCH_MIN_QUERY_LEN:
+        # Quote the query as one phrase so user input can't inject FTS5 syntax.
+        match = '"' + q.replace('"', '""') + '"'
+        fts_ids = (
+            text("SELECT rowid FROM student_fts WHERE student_fts MATCH :q")
+            .bindparams(q=match)
+            .columns(db.column("rowid"))
+        )
+        return Student.id.in_(fts_ids)
+
+    # Short query or no FTS5: substring scan.
+    like = f"%{q}%"
+    return db.or_(Student.name.ilike(like), Student.roll_number.ilike(like))
+
+
+# ---------------- INDEXES ---------------- #
+
+# create_all() doesn't add indexes to tables that already exist, so databases
+# created before these indexes were introduced get them here at startup.
+# Names match the ones SQLAlchemy gives the index=True columns.
+INDEX_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_student_name ON student(name)",
+    "CREATE INDEX IF NOT EXISTS ix_grade_student_id ON grade(student_id)",
+    # Backs the default ORDER BY lower(name).
+    "CREATE INDEX IF NOT EXISTS ix_student_name_lower ON student(lower(name))",
+]
+
+
+def create_indexes():
+    for stmt in INDEX_DDL:
+        db.session.execute(text(stmt))
+    db.session.commit()
 
 
 # ---------------- CREATE DB + DEFAULT ADMIN ---------------- #
 
 with app.app_context():
+    event.listen(db.engine, "connect", set_sqlite_pragmas)
     db.create_all()
+    create_indexes()
+    app.config["SEARCH_INDEX_AVAILABLE"] = create_search_index()
 
     if User.query.first() is None:
         admin = User(username="admin")
@@ -106,28 +296,55 @@ with app.app_context():
 
 # ---------------- ROUTES ---------------- #
 
+STUDENTS_PER_PAGE = 50
+
+
 @app.route("/")
 @login_required
 def index():
     q = request.args.get("q", "").strip()
     sort = request.args.get("sort", "name")
 
-    students_query = Student.query
+    try:
+        pagination, class_avg = list_students(q, sort)
+    except OperationalError:
+        # FTS5 query failed at runtime; retry the page with the ILIKE search.
+        db.session.rollback()
+        pagination, class_avg = list_students(q, sort, use_fts=False)
+
+    return render_template("index.html", students=pagination.items,
+                           pagination=pagination, class_avg=class_avg)
+
+
+def list_students(q, sort, use_fts=True):
+    # Correlated per-student average: with no join/GROUP BY, the name sort can
+    # walk ix_student_name_lower and stop after one page.
+    avg_score = (
+        db.select(db.func.round(db.func.avg(Grade.score), 2))
+        .where(Grade.student_id == Student.id)
+        .scalar_subquery()
+        .label("avg")
+    )
+    students_query = db.session.query(Student.id, Student.name, Student.roll_number, avg_score)
+    averages_query = db.session.query(avg_score).select_from(Student)
 
     if q:
-        like = f"%{q}%"
-        students_query = students_query.filter(
-            db.or_(Student.name.ilike(like), Student.roll_number.ilike(like))
-        )
+        search = student_search_filter(q, use_fts)
+        students_query = students_query.filter(search)
+        averages_query = averages_query.filter(search)
 
-    students = students_query.all()
+    averages = averages_query.subquery()
+    class_avg = db.session.query(db.func.round(db.func.avg(averages.c.avg), 2)).scalar()
 
     if sort == "avg":
-        students = sorted(students, key=lambda s: (s.average() is None, s.average() or 0), reverse=True)
+        students_query = students_query.order_by(
+            avg_score.desc().nulls_last(), db.func.lower(Student.name), Student.id
+        )
     else:
-        students = sorted(students, key=lambda s: s.name.lower())
+        students_query = students_query.order_by(db.func.lower(Student.name), Student.id)
 
-    return render_template("index.html", students=students)
+    pagination = students_query.paginate(per_page=STUDENTS_PER_PAGE, error_out=False)
+    return pagination, class_avg
 
 
 @app.route("/student/add", methods=["GET", "POST"])
@@ -141,12 +358,15 @@ def add_student():
             flash("Name and roll number required.", "danger")
             return redirect(url_for("add_student"))
 
-        if Student.query.filter_by(roll_number=roll).first():
+        try:
+            db.session.add(Student(name=name, roll_number=roll))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
             flash("Roll number already exists.", "danger")
             return redirect(url_for("add_student"))
 
-        db.session.add(Student(name=name, roll_number=roll))
-        db.session.commit()
+        cache.delete_memoized(compute_class_stats)
         flash("Student added!", "success")
         return redirect(url_for("index"))
 
@@ -156,13 +376,22 @@ def add_student():
 @app.route("/student/<int:student_id>")
 @login_required
 def student_detail(student_id):
-    return render_template("student_detail.html", student=Student.query.get_or_404(student_id))
+    # A single row is returned, so joining the grades in costs no duplication
+    # and saves the separate selectin query.
+    # db.one_or_404() can't be used: joined collection loads need unique()
+    # on the result, which it doesn't call.
+    student = db.session.execute(
+        db.select(Student).options(joinedload(Student.grades)).filter_by(id=student_id)
+    ).unique().scalar_one_or_none()
+    if student is None:
+        abort(404)
+    return render_template("student_detail.html", student=student)
 
 
 @app.route("/student/<int:student_id>/edit", methods=["GET", "POST"])
 @login_required
 def edit_student(student_id):
-    student = Student.query.get_or_404(student_id)
+    student = db.get_or_404(Student, student_id)
 
     if request.method == "POST":
         name = request.form.get("name").strip()
@@ -172,13 +401,16 @@ def edit_student(student_id):
             flash("Name and roll number required.", "danger")
             return redirect(url_for("edit_student", student_id=student.id))
 
-        if roll != student.roll_number and Student.query.filter_by(roll_number=roll).first():
+        try:
+            student.name = name
+            student.roll_number = roll
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
             flash("Roll number already exists.", "danger")
-            return redirect(url_for("edit_student", student_id=student.id))
+            return redirect(url_for("edit_student", student_id=student_id))
 
-        student.name = name
-        student.roll_number = roll
-        db.session.commit()
+        cache.delete_memoized(compute_class_stats)
         flash("Updated!", "success")
         return redirect(url_for("student_detail", student_id=student.id))
 
@@ -188,8 +420,14 @@ def edit_student(student_id):
 @app.route("/student/<int:student_id>/delete", methods=["POST"])
 @login_required
 def delete_student(student_id):
-    db.session.delete(Student.query.get_or_404(student_id))
+    # Bulk-delete the grades first rather than relying on ON DELETE CASCADE,
+    # which databases created before the FK gained it don't have.
+    db.session.execute(db.delete(Grade).where(Grade.student_id == student_id))
+    result = db.session.execute(db.delete(Student).where(Student.id == student_id))
+    if result.rowcount == 0:
+        abort(404)
     db.session.commit()
+    cache.delete_memoized(compute_class_stats)
     flash("Deleted!", "success")
     return redirect(url_for("index"))
 
@@ -197,13 +435,13 @@ def delete_student(student_id):
 @app.route("/student/<int:student_id>/grade/add", methods=["POST"])
 @login_required
 def add_grade(student_id):
-    student = Student.query.get_or_404(student_id)
+    ensure_student_exists(student_id)
     subject = request.form.get("subject").strip()
     score = request.form.get("score").strip()
 
     if not subject or not score:
         flash("Subject and score required.", "danger")
-        return redirect(url_for("student_detail", student_id=student.id))
+        return redirect(url_for("student_detail", student_id=student_id))
 
     try:
         score_val = float(score)
@@ -211,54 +449,80 @@ def add_grade(student_id):
             raise ValueError
     except ValueError:
         flash("Score must be a number between 0 and 100.", "danger")
-        return redirect(url_for("student_detail", student_id=student.id))
+        return redirect(url_for("student_detail", student_id=student_id))
 
-    db.session.add(Grade(student_id=student.id, subject=subject, score=score_val))
+    db.session.add(Grade(student_id=student_id, subject=subject, score=score_val))
     db.session.commit()
+    cache.delete_memoized(compute_class_stats)
     flash("Grade added!", "success")
-    return redirect(url_for("student_detail", student_id=student.id))
+    return redirect(url_for("student_detail", student_id=student_id))
 
 
 @app.route("/grade/<int:grade_id>/delete", methods=["POST"])
 @login_required
 def delete_grade(grade_id):
-    grade = Grade.query.get_or_404(grade_id)
+    grade = db.get_or_404(Grade, grade_id)
     sid = grade.student_id
     db.session.delete(grade)
     db.session.commit()
+    cache.delete_memoized(compute_class_stats)
     flash("Grade removed.", "success")
     return redirect(url_for("student_detail", student_id=sid))
 
 
 # ---------------- CSV EXPORT ---------------- #
 
+class Echo:
+    """File-like object whose write() hands the line back to the caller."""
+
+    def write(self, value):
+        return value
+
+
 @app.route("/export/csv")
 @login_required
 def export_csv():
-    si = StringIO()
-    writer = csv.writer(si)
-    writer.writerow(["Name", "Roll", "Subject", "Score"])
-
-    for s in Student.query.order_by(Student.name).all():
-        if s.grades:
-            for g in s.grades:
-                writer.writerow([s.name, s.roll_number, g.subject, g.score])
-        else:
-            writer.writerow([s.name, s.roll_number, "", ""])
+    writer = csv.writer(Echo())
+
+    def generate():
+        yield writer.writerow(["Name", "Roll", "Subject", "Score"])
+
+        # One outer join, streamed in batches; students without grades get a
+        # single row with empty subject/score.
+        rows = (
+            db.session.query(Student.name, Student.roll_number, Grade.subject, Grade.score)
+            .outerjoin(Grade)
+            .order_by(Student.name, Student.id, Grade.id)
+            .yield_per(500)
+        )
+        for name, roll, subject, score in rows:
+            if subject is None:
+                yield writer.writerow([name, roll, "", ""])
+            else:
+                yield writer.writerow([name, roll, subject, score])
 
-    return Response(si.getvalue(), mimetype="text/csv",
+    return Response(stream_with_context(generate()), mimetype="text/csv",
                     headers={"Content-Disposition": "attachment; filename=students.csv"})
 
 
 # ---------------- CHART API ---------------- #
 
+@cache.memoize(timeout=app.config["CLASS_STATS_CACHE_TIMEOUT"])
+def compute_class_stats():
+    rows = (
+        db.session.query(Student.name, db.func.coalesce(db.func.round(db.func.avg(Grade.score), 2), 0))
+        .outerjoin(Grade)
+        .group_by(Student.id)
+        .order_by(Student.id)
+        .all()
+    )
+    return [{"name": name, "average": float(avg)} for name, avg in rows]
+
+
 @app.route("/class-stats")
 @login_required
 def class_stats():
-    return jsonify([
-        {"name": s.name, "average": s.average() or 0}
-        for s in Student.query.all()
-    ])
+    return jsonify(compute_class_stats())
 
 
 # ---------------- AUTH ---------------- #
@@ -271,7 +535,14 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data.strip()).first()
-        if user and user.check_password(form.password.data):
+        if user:
+            ok = user.check_password(form.password.data)
+        else:
+            ok = check_password_hash(DUMMY_HASH, form.password.data)
+        if user and ok:
+            if user.needs_rehash():
+                user.set_password(form.password.data)
+                db.session.commit()
             login_user(user)
             return redirect(url_for("index"))
         flash("Invalid username or password", "danger")
@@ -286,14 +557,16 @@ def register():
     if form.validate_on_submit():
         username = form.username.data.strip()
 
-        if User.query.filter_by(username=username).first():
-            flash("Username already exists.", "danger")
-            return redirect(url_for("register"))
-
         user = User(username=username)
         user.set_password(form.password.data)
-        db.session.add(user)
-        db.session.commit()
+
+        try:
+            db.session.add(user)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash("Username already exists.", "danger")
+            return redirect(url_for("register"))
 
         flash("Account created! Please login.", "success")
         return redirect(url_for("login"))
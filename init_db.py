@@ -1,8 +1,11 @@
-from app import db, app, User
+from app import db, app, User, create_indexes, create_search_index, drop_search_index
 
 with app.app_context():
+    drop_search_index()
     db.drop_all()
     db.create_all()
+    create_indexes()
+    create_search_index()
 
     admin = User(username="admin")
     admin.set_password("admin123")